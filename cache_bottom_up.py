@@ -7,12 +7,12 @@ detections = 20
 mean_pooled_featuers = MeanPooledImageFeatures(["imagenet"])
 bottom_up_features = BottomUpImageFeatures(detections)
 
-keys = list(mean_pooled_featuers.features.keys())
+keys = list(mean_pooled_featuers.id2row.keys())
 missing_keys = set()
 by_key = {}
 
 for key in tqdm.tqdm(keys):
-    scene, viewpoint = key.split('_')
+    scene, viewpoint = key
     try:
         by_key[(scene, viewpoint)] = [nt._asdict() for nt in bottom_up_features._get_viewpoint_features(scene, viewpoint)]
     except Exception as e:
@@ -1,4 +1,5 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 #include <numpy/ndarrayobject.h>
 #include <numpy/npy_math.h>
 #include <iostream>
@@ -111,12 +112,30 @@ namespace mattersim {
         }
         void newEpisode(const std::string& scanId, const std::string& viewpointId=std::string(), 
               double heading=0, double elevation=0) {
+            // no Python objects are touched, so let other threads run
+            py::gil_scoped_release release;
             sim.newEpisode(scanId, viewpointId, heading, elevation);
         }
         SimStatePython *getState() {
             return new SimStatePython(sim.getState(), sim.renderingEnabled);
         }
+        static void newEpisodes(std::vector<SimulatorPython*> sims,
+              const std::vector<std::string>& scanIds,
+              const std::vector<std::string>& viewpointIds,
+              const std::vector<double>& headings,
+              const std::vector<double>& elevations) {
+            if (scanIds.size() != sims.size() || viewpointIds.size() != sims.size() ||
+                    headings.size() != sims.size() || elevations.size() != sims.size()) {
+                throw std::invalid_argument("MatterSim: newEpisodes arguments must all have the same length");
+            }
+            // one call from Python for the whole batch
+            py::gil_scoped_release release;
+            for (size_t i = 0; i < sims.size(); ++i) {
+                sims[i]->sim.newEpisode(scanIds[i], viewpointIds[i], headings[i], elevations[i]);
+            }
+        }
         void makeAction(int index, double heading, double elevation) {
+            py::gil_scoped_release release;
             sim.makeAction(index, heading, elevation);
         }
         void close() {
@@ -130,6 +149,7 @@ namespace mattersim {
 using namespace mattersim;
 
 PYBIND11_MODULE(MatterSim, m) {
+    m.def("newEpisodes", &SimulatorPython::newEpisodes);
     py::class_<ViewPointPython>(m, "ViewPoint")
         .def_readonly("viewpointId", &ViewPointPython::viewpointId)
         .def_readonly("ix", &ViewPointPython::ix)
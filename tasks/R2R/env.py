@@ -8,7 +8,6 @@ import numpy as np
 import math
 import json
 import random
-import networkx as nx
 import functools
 import os.path
 import time
@@ -18,10 +17,12 @@ import os
 import os.path
 import sys
 import itertools
+import base64
+import concurrent.futures
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 
-from utils import load_datasets, load_nav_graphs, structured_map, vocab_pad_idx, decode_base64, k_best_indices, try_cuda, spatial_feature_from_bbox
+from utils import load_datasets, load_nav_graphs, all_pairs_shortest_paths, structured_map, flatten, vocab_pad_idx, k_best_indices, try_cuda, spatial_feature_from_bbox
 
 import torch
 from torch.autograd import Variable
@@ -55,6 +56,10 @@ csv.field_size_limit(sys.maxsize)
 # assert len(FOLLOWER_MODEL_ACTIONS) == len(FOLLOWER_ENV_ACTIONS)
 
 angle_inc = np.pi / 6.
+two_pi = 2 * np.pi
+
+# max number of memoized teacher actions kept by R2RBatch
+TEACHER_CACHE_SIZE = 200000
 
 
 def _build_action_embedding(adj_loc_list, features):
@@ -68,10 +73,11 @@ def _build_action_embedding(adj_loc_list, features):
         loc_embedding = embedding[a, feature_dim:]
         rel_heading = adj_dict['rel_heading']
         rel_elevation = adj_dict['rel_elevation']
-        loc_embedding[0:32] = np.sin(rel_heading)
-        loc_embedding[32:64] = np.cos(rel_heading)
-        loc_embedding[64:96] = np.sin(rel_elevation)
-        loc_embedding[96:] = np.cos(rel_elevation)
+        # scalar math functions; numpy ufuncs are much slower on single floats
+        loc_embedding[0:32] = math.sin(rel_heading)
+        loc_embedding[32:64] = math.cos(rel_heading)
+        loc_embedding[64:96] = math.sin(rel_elevation)
+        loc_embedding[96:] = math.cos(rel_elevation)
     return embedding
 
 
@@ -97,17 +103,17 @@ def build_viewpoint_loc_embedding(viewIndex):
 
 
 # pre-compute all the 36 possible paranoram location embeddings
-_static_loc_embeddings = [
-    build_viewpoint_loc_embedding(viewIndex) for viewIndex in range(36)]
+_static_loc_embeddings = np.stack([
+    build_viewpoint_loc_embedding(viewIndex) for viewIndex in range(36)])
 
 
 def _loc_distance(loc):
-    return np.sqrt(loc.rel_heading ** 2 + loc.rel_elevation ** 2)
+    return math.sqrt(loc.rel_heading ** 2 + loc.rel_elevation ** 2)
 
 
 def _canonical_angle(x):
     ''' Make angle in (-pi, +pi) '''
-    return x - 2 * np.pi * round(x / (2 * np.pi))
+    return x - two_pi * round(x / two_pi)
 
 
 def _adjust_heading(sim, heading):
@@ -228,6 +234,34 @@ WorldState = namedtuple("WorldState", ["scanId", "viewpointId", "heading", "elev
 
 BottomUpViewpoint = namedtuple("BottomUpViewpoint", ["cls_prob", "image_features", "attribute_indices", "object_indices", "spatial_features", "no_object_mask"])
 
+class Observation(namedtuple("Observation", ["instr_id", "scan", "viewpoint", "viewIndex", "heading", "elevation", "feature", "step", "adj_loc_list", "action_embedding", "navigableLocations", "instructions", "teacher", "instr_encoding", "instr_length"])):
+    ''' An observation returned by R2RBatch.observe. It can also be read like
+        the dicts observe used to return: ob['field'], 'field' in ob,
+        ob.get('field') and ob.keys() (so dict(ob) works) all go by field name.
+        teacher and the instruction encoding fields are None when not
+        available, and count as missing keys then, as they were absent from
+        the dicts. It is still a tuple, so len(ob) and iterating over ob see
+        all the field values. '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return super(Observation, self).__getitem__(key)
+
+    def __contains__(self, key):
+        return key in self._fields and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self._fields else None
+        return default if value is None else value
+
+    def keys(self):
+        return [field for field in self._fields if getattr(self, field) is not None]
+
 def load_world_state(sim, world_state):
     sim.newEpisode(*world_state)
 
@@ -312,7 +346,7 @@ class ImageFeatures(object):
                 raise NotImplementedError('convolutional_attention has not been implemented for panorama environment')
             else:
                 assert image_feature_type == "mean_pooled"
-                feats.append(MeanPooledImageFeatures(args.image_feature_datasets))
+                feats.append(MeanPooledImageFeatures(args.image_feature_datasets, half_precision=args.half_precision_image_features))
         return feats
 
     @staticmethod
@@ -323,6 +357,7 @@ class ImageFeatures(object):
         argument_parser.add_argument("--bottom_up_detections", type=int, default=20)
         argument_parser.add_argument("--bottom_up_detection_embedding_size", type=int, default=20)
         argument_parser.add_argument("--downscale_convolutional_features", action='store_true')
+        argument_parser.add_argument("--half_precision_image_features", action='store_true', help="keep mean_pooled features in memory as float16, halving their size; observations are still float32")
 
     def get_name(self):
         raise NotImplementedError("get_name")
@@ -334,6 +369,9 @@ class ImageFeatures(object):
     def get_features(self, state):
         raise NotImplementedError("get_features")
 
+    def get_features_batch(self, states):
+        return np.stack([self.get_features(state) for state in states])
+
 class NoImageFeatures(ImageFeatures):
     feature_dim = ImageFeatures.MEAN_POOLED_DIM
 
@@ -344,43 +382,131 @@ class NoImageFeatures(ImageFeatures):
     def get_features(self, state):
         return self.features
 
+    def get_features_batch(self, states):
+        return np.zeros((len(states),) + self.features.shape, dtype=np.float32)
+
     def get_name(self):
         return "none"
 
 class MeanPooledImageFeatures(ImageFeatures):
-    def __init__(self, image_feature_datasets):
+    def __init__(self, image_feature_datasets, half_precision=False):
         image_feature_datasets = sorted(image_feature_datasets)
         self.image_feature_datasets = image_feature_datasets
+        self.half_precision = half_precision
+        self.dtype = np.float16 if half_precision else np.float32
 
         self.mean_pooled_feature_stores = [paths.mean_pooled_feature_store_paths[dataset]
                                            for dataset in image_feature_datasets]
         self.feature_dim = MeanPooledImageFeatures.MEAN_POOLED_DIM * len(image_feature_datasets)
-        print('Loading image features from %s' % ', '.join(self.mean_pooled_feature_stores))
-        tsv_fieldnames = ['scanId', 'viewpointId', 'image_w','image_h', 'vfov', 'features']
-        self.features = defaultdict(list)
-        for mpfs in self.mean_pooled_feature_stores:
-            with open(mpfs, "rt") as tsv_in_file:
-                reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames = tsv_fieldnames)
-                for item in reader:
-                    assert int(item['image_h']) == ImageFeatures.IMAGE_H
-                    assert int(item['image_w']) == ImageFeatures.IMAGE_W
-                    assert int(item['vfov']) == ImageFeatures.VFOV
-                    long_id = self._make_id(item['scanId'], item['viewpointId'])
-                    features = np.frombuffer(decode_base64(item['features']), dtype=np.float32).reshape((ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM))
-                    self.features[long_id].append(features)
-        assert all(len(feats) == len(self.mean_pooled_feature_stores) for feats in self.features.values())
-        self.features = {
-            long_id: np.concatenate(feats, axis=1)
-            for long_id, feats in self.features.items()
-        }
-
-    def _make_id(self, scanId, viewpointId):
-        return scanId + '_' + viewpointId
+        # all features live in one contiguous (num_viewpoints, 36, feature_dim)
+        # array; id2row maps (scanId, viewpointId) to the row in that array.
+        # Parsing the tsv stores is slow, so the parsed array is saved next to
+        # them and memory-mapped on later runs.
+        cache_path, index_path = self._cache_paths()
+        if self._load_cache(cache_path, index_path):
+            print('Loaded image features from cache %s' % cache_path)
+        else:
+            print('Loading image features from %s' % ', '.join(self.mean_pooled_feature_stores))
+            self._load_tsv(cache_path, index_path)
+
+    def _cache_paths(self):
+        name = self.get_name()
+        if self.half_precision:
+            name += '_float16'
+        prefix = os.path.join(os.path.dirname(self.mean_pooled_feature_stores[0]), name)
+        return prefix + '.npy', prefix + '.idx.json'
+
+    def _load_cache(self, cache_path, index_path):
+        ''' Memory-map the cached feature array if it is newer than all the tsv
+            stores. Returns False if there is no usable cache. '''
+        if not (os.path.exists(cache_path) and os.path.exists(index_path)):
+            return False
+        stores_mtime = max(os.path.getmtime(mpfs) for mpfs in self.mean_pooled_feature_stores)
+        if min(os.path.getmtime(cache_path), os.path.getmtime(index_path)) < stores_mtime:
+            return False
+        try:
+            # the index is the list of (scanId, viewpointId) pairs in row order
+            with open(index_path) as f:
+                id2row = {(scanId, viewpointId): row
+                          for row, (scanId, viewpointId) in enumerate(json.load(f))}
+            features_arr = np.load(cache_path, mmap_mode='r')
+        except Exception as e:
+            print('Ignoring unreadable feature cache %s: %s' % (cache_path, e))
+            return False
+        if features_arr.shape != (len(id2row), ImageFeatures.NUM_VIEWS, self.feature_dim) or features_arr.dtype != self.dtype:
+            print('Ignoring feature cache %s with unexpected shape %s or dtype %s' % (cache_path, features_arr.shape, features_arr.dtype))
+            return False
+        self.id2row = id2row
+        self.features_arr = features_arr
+        return True
+
+    def _load_tsv(self, cache_path, index_path):
+        with open(self.mean_pooled_feature_stores[0], "rb") as tsv_in_file:
+            num_rows = sum(1 for _ in tsv_in_file)
+        shape = (num_rows, ImageFeatures.NUM_VIEWS, self.feature_dim)
+        # fill a memmap backed by the cache file directly, so the full array
+        # never has to be resident; fall back to memory if it can't be written.
+        # The temporary names are per-process so concurrent builds don't clobber
+        # each other's files.
+        tmp_suffix = '.%d.tmp' % os.getpid()
+        cache_tmp = cache_path + tmp_suffix
+        index_tmp = index_path + tmp_suffix
+        try:
+            self.features_arr = np.lib.format.open_memmap(cache_tmp, mode='w+', dtype=self.dtype, shape=shape)
+        except Exception as e:
+            print('Not caching image features to %s: %s' % (cache_path, e))
+            cache_tmp = None
+            self.features_arr = np.empty(shape, dtype=self.dtype)
+
+        self.id2row = {}
+        for d, mpfs in enumerate(self.mean_pooled_feature_stores):
+            # each dataset fills its own block of columns
+            cols_start = d * ImageFeatures.MEAN_POOLED_DIM
+            cols_end = cols_start + ImageFeatures.MEAN_POOLED_DIM
+            # rows are scanId, viewpointId, image_w, image_h, vfov, features;
+            # split the raw bytes ourselves rather than going through csv
+            with open(mpfs, "rb") as tsv_in_file:
+                for i, line in enumerate(tsv_in_file):
+                    cols = line.rstrip(b'\r\n').split(b'\t')
+                    if i == 0:
+                        # the camera settings are the same for every row
+                        assert int(cols[3]) == ImageFeatures.IMAGE_H
+                        assert int(cols[2]) == ImageFeatures.IMAGE_W
+                        assert int(cols[4]) == ImageFeatures.VFOV
+                    key = (cols[0].decode('ascii'), cols[1].decode('ascii'))
+                    if d == 0:
+                        self.id2row[key] = i
+                    features = np.frombuffer(base64.b64decode(cols[5]), dtype=np.float32).reshape((ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM))
+                    self.features_arr[self.id2row[key], :, cols_start:cols_end] = features
+            assert i + 1 == len(self.id2row) == len(self.features_arr)
+
+        if cache_tmp is not None:
+            self.features_arr.flush()
+            del self.features_arr
+            # map our own file before publishing it, so this process keeps its
+            # array even if another process replaces the cache afterwards
+            self.features_arr = np.load(cache_tmp, mmap_mode='r')
+            try:
+                with open(index_tmp, 'w') as f:
+                    json.dump(list(self.id2row), f)
+                os.replace(index_tmp, index_path)
+                os.replace(cache_tmp, cache_path)
+            except OSError as e:
+                print('Not caching image features to %s: %s' % (cache_path, e))
+                for path in (index_tmp, cache_tmp):
+                    if os.path.exists(path):
+                        os.remove(path)
 
     def get_features(self, state):
-        long_id = self._make_id(state.scanId, state.location.viewpointId)
         # Return feature of all the 36 views
-        return self.features[long_id]
+        return self.features_arr[self.id2row[(state.scanId, state.location.viewpointId)]]
+
+    def get_features_batch(self, states):
+        ''' Gather the 36-view features of a list of states in one indexing op,
+            returning an array of shape (len(states), 36, feature_dim) '''
+        rows = [self.id2row[(state.scanId, state.location.viewpointId)]
+                for state in states]
+        return self.features_arr[rows]
 
     def get_name(self):
         name = '+'.join(sorted(self.image_feature_datasets))
@@ -398,9 +524,19 @@ class ConvolutionalImageFeatures(ImageFeatures):
         self.convolutional_feature_stores = [paths.convolutional_feature_store_paths[dataset]
                                              for dataset in image_feature_datasets]
 
+        # keep the memmap handles of recently used viewpoints open so repeated
+        # visits don't reopen the file and reparse the .npy header. Each handle
+        # holds a file descriptor, so the cache is kept well under the usual
+        # open file limit; call self._conv_cache.cache_clear() to release them.
+        self._conv_cache = functools.lru_cache(maxsize=512)(self._open_conv_mmap)
+
     def _make_id(self, scanId, viewpointId):
         return scanId + '_' + viewpointId
 
+    def _open_conv_mmap(self, cfs, scanId, viewpointId):
+        path = os.path.join(cfs, scanId, "%s.npy" % viewpointId)
+        return np.load(path, mmap_mode='r')
+
     @functools.lru_cache(maxsize=3000)
     def _get_convolutional_features(self, scanId, viewpointId, viewIndex):
         feats = []
@@ -410,9 +546,7 @@ class ConvolutionalImageFeatures(ImageFeatures):
                 this_feats = np.load(path)
             else:
                 # memmap for loading subfeatures
-                path = os.path.join(cfs, scanId, "%s.npy" % viewpointId)
-                mmapped = np.load(path, mmap_mode='r')
-                this_feats = mmapped[viewIndex,:,:,:]
+                this_feats = self._conv_cache(cfs, scanId, viewpointId)[viewIndex,:,:,:]
             feats.append(this_feats)
         if len(feats) > 1:
             return np.concatenate(feats, axis=1)
@@ -586,7 +720,7 @@ class EnvBatch():
     ''' A simple wrapper for a batch of MatterSim environments,
         using discretized viewpoints and pretrained features '''
 
-    def __init__(self, batch_size, beam_size):
+    def __init__(self, batch_size, beam_size, num_threads=None):
         self.sims = []
         self.batch_size = batch_size
         self.beam_size = beam_size
@@ -596,6 +730,17 @@ class EnvBatch():
                 sim = make_sim(ImageFeatures.IMAGE_W, ImageFeatures.IMAGE_H, ImageFeatures.VFOV)
                 beam.append(sim)
             self.sims.append(beam)
+        # id(sim) -> the WorldState the sim was last left in, so that reloading
+        # a sim that is already in the requested state can be skipped
+        self._loaded_states = {}
+        # the simulator releases the GIL inside newEpisode and makeAction, so
+        # batch rows can optionally be stepped from a thread pool. Most of the
+        # per-row work still holds the GIL, so this is off by default.
+        if num_threads:
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(num_threads, batch_size))
+        else:
+            self._pool = None
 
     def sims_view(self, beamed):
         if beamed:
@@ -603,27 +748,49 @@ class EnvBatch():
         else:
             return (s[0] for s in self.sims)
 
+    def _map(self, f, beamed, *args):
+        ''' structured_map(f, self.sims_view(beamed), *args, nested=beamed), but
+            with each batch row run as one task in the thread pool if there is
+            one. A row's beam entries run serially since they may share
+            simulators. '''
+        if self._pool is None:
+            return structured_map(f, self.sims_view(beamed), *args, nested=beamed)
+        if beamed:
+            def run_row(*t):
+                return [f(*inner_t) for inner_t in zip(*t)]
+            return list(self._pool.map(run_row, self.sims_view(True), *args))
+        return list(self._pool.map(f, self.sims_view(False), *args))
+
+    def _load_world_state(self, sim, world_state):
+        ''' load_world_state, unless the sim is already in world_state '''
+        if self._loaded_states.get(id(sim)) != world_state:
+            load_world_state(sim, world_state)
+            self._loaded_states[id(sim)] = world_state
+
     def newEpisodes(self, scanIds, viewpointIds, headings, beamed=False):
         assert len(scanIds) == len(viewpointIds)
         assert len(headings) == len(viewpointIds)
         assert len(scanIds) == len(self.sims)
-        world_states = []
-        for i, (scanId, viewpointId, heading) in enumerate(zip(scanIds, viewpointIds, headings)):
-            world_state = WorldState(scanId, viewpointId, heading, 0)
-            if beamed:
-                world_states.append([world_state])
-            else:
-                world_states.append(world_state)
-            load_world_state(self.sims[i][0], world_state)
+        world_states = [WorldState(scanId, viewpointId, heading, 0)
+                        for scanId, viewpointId, heading in zip(scanIds, viewpointIds, headings)]
         assert len(world_states) == len(scanIds)
+        # load the whole batch with a single call into the simulator
+        MatterSim.newEpisodes(
+            [s[0] for s in self.sims], list(scanIds), list(viewpointIds),
+            [float(heading) for heading in headings], [0.0] * len(world_states))
+        for s, world_state in zip(self.sims, world_states):
+            self._loaded_states[id(s[0])] = world_state
+        if beamed:
+            return [[world_state] for world_state in world_states]
         return world_states
 
     def getStates(self, world_states, beamed=False):
         ''' Get list of states. '''
         def f(sim, world_state):
-            load_world_state(sim, world_state)
+            self._load_world_state(sim, world_state)
+            # this looks all around but leaves the sim back in world_state
             return _get_panorama_states(sim)
-        return structured_map(f, self.sims_view(beamed), world_states, nested=beamed)
+        return self._map(f, beamed, world_states)
 
     def makeActions(self, world_states, actions, last_obs, beamed=False):
         ''' Take an action using the full state dependent action interface (with batched input).
@@ -631,14 +798,16 @@ class EnvBatch():
             0 means staying still (i.e. stop)
         '''
         def f(sim, world_state, action, last_ob):
-            load_world_state(sim, world_state)
+            self._load_world_state(sim, world_state)
             # load the location attribute corresponding to the action
             loc_attr = last_ob['adj_loc_list'][action]
             _navigate_to_location(
                 sim, loc_attr['nextViewpointId'], loc_attr['absViewIndex'])
             # sim.makeAction(index, heading, elevation)
-            return get_world_state(sim)
-        return structured_map(f, self.sims_view(beamed), world_states, actions, last_obs, nested=beamed)
+            new_world_state = get_world_state(sim)
+            self._loaded_states[id(sim)] = new_world_state
+            return new_world_state
+        return self._map(f, beamed, world_states, actions, last_obs)
 
     # def makeSimpleActions(self, simple_indices, beamed=False):
     #     ''' Take an action using a simple interface: 0-forward, 1-turn left, 2-turn right, 3-look up, 4-look down.
@@ -661,13 +830,35 @@ class EnvBatch():
     #     structured_map(f, self.sims_view(beamed), simple_indices, nested=beamed)
     #     return None
 
+@functools.lru_cache(maxsize=None)
+def _load_scan_nav_graph(scan):
+    ''' Connectivity graph and all shortest paths of a scan. Cached, so that the
+        train and validation envs of one process share them; callers must
+        not modify the results. '''
+    G = load_nav_graphs([scan])[scan]
+    viewpoint_ids, distances, next_hop = all_pairs_shortest_paths(G)
+    vp2idx = {vp: i for i, vp in enumerate(viewpoint_ids)}
+    return G, viewpoint_ids, vp2idx, distances, next_hop
+
 class R2RBatch():
     ''' Implements the Room to Room navigation task, using discretized viewpoints and pretrained features '''
 
-    def __init__(self, image_features_list, batch_size=100, seed=10, splits=['train'], tokenizer=None, beam_size=1, instruction_limit=None):
+    def __init__(self, image_features_list, batch_size=100, seed=10, splits=['train'], tokenizer=None, beam_size=1, instruction_limit=None, num_threads=None):
         self.image_features_list = image_features_list
-        self.data = []
-        self.scans = []
+        self.num_threads = num_threads
+        self.tokenizer = tokenizer
+        # instructions are encoded lazily, the first time they land in a
+        # minibatch; repeated instruction strings share one encoding
+        if tokenizer:
+            self._encode_sentence = functools.lru_cache(maxsize=None)(tokenizer.encode_sentence)
+        # one entry per instruction, stored as parallel columns indexed by
+        # row; minibatches are arrays of row indices into them
+        self.instr_ids = []
+        self.scan_ids = []
+        self.path_starts = []
+        self.path_goals = []
+        self.instructions = []
+        headings = []
         self.gt = {}
         for item in load_datasets(splits):
             # Split multiple instructions into separate entries
@@ -677,27 +868,30 @@ class R2RBatch():
             if instruction_limit:
                 instructions = instructions[:instruction_limit]
             for j,instr in enumerate(instructions):
-                self.scans.append(item['scan'])
-                new_item = dict(item)
-                new_item['instr_id'] = '%s_%d' % (item['path_id'], j)
-                new_item['instructions'] = instr
-                if tokenizer:
-                    self.tokenizer = tokenizer
-                    new_item['instr_encoding'], new_item['instr_length'] = tokenizer.encode_sentence(instr)
-                else:
-                    self.tokenizer = None
-                self.data.append(new_item)
-        self.scans = set(self.scans)
+                self.instr_ids.append('%s_%d' % (item['path_id'], j))
+                self.scan_ids.append(item['scan'])
+                self.path_starts.append(item['path'][0])
+                self.path_goals.append(item['path'][-1])
+                self.instructions.append(instr)
+                headings.append(item['heading'])
+        self.headings = np.array(headings, dtype=np.float64)
+        # filled in by _next_minibatch; a length of -1 means not encoded yet
+        self.instr_encodings = [None] * len(self.instr_ids)
+        self.instr_lengths = np.full(len(self.instr_ids), -1, dtype=np.int32)
+        self.scans = set(self.scan_ids)
         self.splits = splits
         self.seed = seed
         random.seed(self.seed)
-        random.shuffle(self.data)
+        self._perm = np.arange(len(self.instr_ids))
+        random.shuffle(self._perm)
         self.ix = 0
         self.batch_size = batch_size
         self._load_nav_graphs()
+        # (scanId, viewpointId, viewIndex, goalViewpointId) -> teacher action
+        self._teacher_cache = {}
         self.set_beam_size(beam_size)
         self.print_progress = False
-        print('R2RBatch loaded with %d instructions, using splits: %s' % (len(self.data), ",".join(splits)))
+        print('R2RBatch loaded with %d instructions, using splits: %s' % (len(self.instr_ids), ",".join(splits)))
 
     def set_beam_size(self, beam_size, force_reload=False):
         # warning: this will invalidate the environment, self.reset() should be called afterward!
@@ -707,32 +901,46 @@ class R2RBatch():
             invalid = True
         if force_reload or invalid:
             self.beam_size = beam_size
-            self.env = EnvBatch(self.batch_size, beam_size)
+            self.env = EnvBatch(self.batch_size, beam_size, num_threads=self.num_threads)
 
     def _load_nav_graphs(self):
         ''' Load connectivity graph for each scan, useful for reasoning about shortest paths '''
         print('Loading navigation graphs for %d scans' % len(self.scans))
-        self.graphs = load_nav_graphs(self.scans)
-        self.paths = {}
-        for scan,G in self.graphs.items(): # compute all shortest paths
-            self.paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
+        # shortest paths are stored as dense matrices indexed through
+        # vp2idx[scan]; the teacher only needs the first step of each path, so
+        # next_hop[scan][i, j] is the index of the viewpoint after i towards j
+        self.graphs = {}
+        self.viewpoint_ids = {}
+        self.vp2idx = {}
+        self.next_hop = {}
         self.distances = {}
-        for scan,G in self.graphs.items(): # compute all shortest paths
-            self.distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        for scan in self.scans:
+            G, viewpoint_ids, vp2idx, distances, next_hop = _load_scan_nav_graph(scan)
+            self.graphs[scan] = G
+            self.viewpoint_ids[scan] = viewpoint_ids
+            self.vp2idx[scan] = vp2idx
+            self.next_hop[scan] = next_hop
+            self.distances[scan] = distances
 
     def _next_minibatch(self, sort_instr_length):
-        batch = self.data[self.ix:self.ix+self.batch_size]
+        # copy, since the slice would otherwise see the reshuffle below
+        batch_ix = self._perm[self.ix:self.ix+self.batch_size].copy()
         if self.print_progress:
-            sys.stderr.write("\rix {} / {}".format(self.ix, len(self.data)))
-        if len(batch) < self.batch_size:
-            random.shuffle(self.data)
-            self.ix = self.batch_size - len(batch)
-            batch += self.data[:self.ix]
+            sys.stderr.write("\rix {} / {}".format(self.ix, len(self._perm)))
+        if len(batch_ix) < self.batch_size:
+            random.shuffle(self._perm)
+            self.ix = self.batch_size - len(batch_ix)
+            batch_ix = np.concatenate((batch_ix, self._perm[:self.ix]))
         else:
             self.ix += self.batch_size
+        if self.tokenizer:
+            for ix in batch_ix:
+                if self.instr_encodings[ix] is None:
+                    self.instr_encodings[ix], self.instr_lengths[ix] = self._encode_sentence(self.instructions[ix])
         if sort_instr_length:
-            batch = sorted(batch, key=lambda item: item['instr_length'], reverse=True)
-        self.batch = batch
+            # stable, so equal lengths keep their shuffled order
+            batch_ix = batch_ix[np.argsort(-self.instr_lengths[batch_ix], kind='mergesort')]
+        self.batch_ix = batch_ix
 
     def reset_epoch(self):
         ''' Reset the data index to beginning of epoch. Primarily for testing.
@@ -744,77 +952,102 @@ class R2RBatch():
         Determine next action on the shortest path to goal,
         for supervised training.
         '''
-        if state.location.viewpointId == goalViewpointId:
+        scanId = state.scanId
+        viewpointId = state.location.viewpointId
+        if viewpointId == goalViewpointId:
             return 0  # do nothing
-        path = self.paths[state.scanId][state.location.viewpointId][
-            goalViewpointId]
-        nextViewpointId = path[1]
+        # adj_loc_list is fully determined by the location and view index, so
+        # the action can be reused whenever the same state and goal come back
+        teacher_cache = self._teacher_cache
+        key = (scanId, viewpointId, state.viewIndex, goalViewpointId)
+        if key in teacher_cache:
+            return teacher_cache[key]
+        vp2idx = self.vp2idx[scanId]
+        next_ix = self.next_hop[scanId][vp2idx[viewpointId], vp2idx[goalViewpointId]]
+        nextViewpointId = self.viewpoint_ids[scanId][next_ix]
         for n_a, loc_attr in enumerate(adj_loc_list):
             if loc_attr['nextViewpointId'] == nextViewpointId:
+                if len(teacher_cache) >= TEACHER_CACHE_SIZE:
+                    teacher_cache.clear()
+                teacher_cache[key] = n_a
                 return n_a
 
         # Next nextViewpointId not found! This should not happen!
         print('adj_loc_list:', adj_loc_list)
         print('nextViewpointId:', nextViewpointId)
-        long_id = '{}_{}'.format(state.scanId, state.location.viewpointId)
+        long_id = '{}_{}'.format(scanId, viewpointId)
         print('longId:', long_id)
         raise Exception('Bug: nextViewpointId not in adj_loc_list')
 
-    def observe(self, world_states, beamed=False, include_teacher=True):
-        #start_time = time.time()
+    def _build_ob(self, ix, state, adj_loc_list, feature, feature_with_loc, include_teacher):
+        assert self.scan_ids[ix] == state.scanId
+        encoded = self.instr_encodings[ix] is not None
+        return Observation(
+            instr_id=self.instr_ids[ix],
+            scan=state.scanId,
+            viewpoint=state.location.viewpointId,
+            viewIndex=state.viewIndex,
+            heading=state.heading,
+            elevation=state.elevation,
+            feature=[feature_with_loc],
+            step=state.step,
+            adj_loc_list=adj_loc_list,
+            action_embedding=_build_action_embedding(adj_loc_list, feature),
+            navigableLocations=state.navigableLocations,
+            instructions=self.instructions[ix],
+            teacher=self._shortest_path_action(state, adj_loc_list, self.path_goals[ix]) if include_teacher else None,
+            instr_encoding=self.instr_encodings[ix],
+            instr_length=int(self.instr_lengths[ix]) if encoded else None)
+
+    def _featurize(self, sim_states):
+        # gather the features of every state at once into a single
+        # (num_states, 36, feature_dim + 128) block; each ob gets a view of its
+        # row. A fresh block is needed each call since callers keep past obs.
+        assert len(self.image_features_list) == 1, 'for now, only work with MeanPooled feature'
+        features = self.image_features_list[0].get_features_batch(sim_states)
+        feature_dim = features.shape[-1]
+        features_with_loc = np.empty(features.shape[:2] + (feature_dim + 128,), np.float32)
+        features_with_loc[:, :, :feature_dim] = features
+        features_with_loc[:, :, feature_dim:] = _static_loc_embeddings[[state.viewIndex for state in sim_states]]
+        return features, features_with_loc
+
+    def _observe_unbeamed(self, world_states, include_teacher):
+        all_states = self.env.getStates(world_states)
+        features, features_with_loc = self._featurize([state for state, _ in all_states])
+        return [self._build_ob(ix, state, adj_loc_list, features[k], features_with_loc[k], include_teacher)
+                for k, (ix, (state, adj_loc_list)) in enumerate(zip(self.batch_ix, all_states))]
+
+    def _observe_beamed(self, world_states, include_teacher):
+        all_states = self.env.getStates(world_states, beamed=True)
+        features, features_with_loc = self._featurize([state for state, _ in flatten(all_states)])
         obs = []
-        for i,states_beam in enumerate(self.env.getStates(world_states, beamed=beamed)):
-            item = self.batch[i]
-            obs_batch = []
-            for state, adj_loc_list in states_beam if beamed else [states_beam]:
-                assert item['scan'] == state.scanId
-                feature = [featurizer.get_features(state) for featurizer in self.image_features_list]
-                assert len(feature) == 1, 'for now, only work with MeanPooled feature'
-                feature_with_loc = np.concatenate((feature[0], _static_loc_embeddings[state.viewIndex]), axis=-1)
-                action_embedding = _build_action_embedding(adj_loc_list, feature[0])
-                ob = {
-                    'instr_id' : item['instr_id'],
-                    'scan' : state.scanId,
-                    'viewpoint' : state.location.viewpointId,
-                    'viewIndex' : state.viewIndex,
-                    'heading' : state.heading,
-                    'elevation' : state.elevation,
-                    'feature' : [feature_with_loc],
-                    'step' : state.step,
-                    'adj_loc_list' : adj_loc_list,
-                    'action_embedding': action_embedding,
-                    'navigableLocations' : state.navigableLocations,
-                    'instructions' : item['instructions'],
-                }
-                if include_teacher:
-                    ob['teacher'] = self._shortest_path_action(state, adj_loc_list, item['path'][-1])
-                if 'instr_encoding' in item:
-                    ob['instr_encoding'] = item['instr_encoding']
-                if 'instr_length' in item:
-                    ob['instr_length'] = item['instr_length']
-                obs_batch.append(ob)
-            if beamed:
-                obs.append(obs_batch)
-            else:
-                assert len(obs_batch) == 1
-                obs.append(obs_batch[0])
-
-        #end_time = time.time()
-        #print("get obs in {} seconds".format(end_time - start_time))
+        k = 0
+        for ix, states_beam in zip(self.batch_ix, all_states):
+            obs_beam = []
+            for state, adj_loc_list in states_beam:
+                obs_beam.append(self._build_ob(
+                    ix, state, adj_loc_list, features[k], features_with_loc[k], include_teacher))
+                k += 1
+            obs.append(obs_beam)
         return obs
 
-    def get_starting_world_states(self, instance_list, beamed=False):
-        scanIds = [item['scan'] for item in instance_list]
-        viewpointIds = [item['path'][0] for item in instance_list]
-        headings = [item['heading'] for item in instance_list]
+    def observe(self, world_states, beamed=False, include_teacher=True):
+        if beamed:
+            return self._observe_beamed(world_states, include_teacher)
+        return self._observe_unbeamed(world_states, include_teacher)
+
+    def get_starting_world_states(self, batch_ix, beamed=False):
+        scanIds = [self.scan_ids[ix] for ix in batch_ix]
+        viewpointIds = [self.path_starts[ix] for ix in batch_ix]
+        headings = self.headings[batch_ix].tolist()
         return self.env.newEpisodes(scanIds, viewpointIds, headings, beamed=beamed)
 
     def reset(self, sort=False, beamed=False, load_next_minibatch=True):
         ''' Load a new minibatch / episodes. '''
         if load_next_minibatch:
             self._next_minibatch(sort)
-        assert len(self.batch) == self.batch_size
-        return self.get_starting_world_states(self.batch, beamed=beamed)
+        assert len(self.batch_ix) == self.batch_size
+        return self.get_starting_world_states(self.batch_ix, beamed=beamed)
 
     def step(self, world_states, actions, last_obs, beamed=False):
         ''' Take action (same interface as makeActions) '''
@@ -10,6 +10,8 @@ import math
 from collections import Counter
 import numpy as np
 import networkx as nx
+import scipy.sparse
+import scipy.sparse.csgraph
 import subprocess
 import itertools
 import base64
@@ -51,6 +53,30 @@ def load_nav_graphs(scans):
     return graphs
 
 
+def all_pairs_shortest_paths(G):
+    ''' Shortest paths between all viewpoints of a connectivity graph.
+        Returns the list of viewpoint ids, which defines the row/column order,
+        a float32 matrix of path lengths, and an int32 matrix whose [i, j]
+        entry is the index of the first viewpoint after i on the path to j
+        (j itself when i == j). '''
+    viewpoint_ids = list(G.nodes())
+    vp2idx = {vp: i for i, vp in enumerate(viewpoint_ids)}
+    rows, cols, weights = [], [], []
+    for u, v, weight in G.edges(data='weight'):
+        rows.append(vp2idx[u])
+        cols.append(vp2idx[v])
+        weights.append(weight)
+    n = len(viewpoint_ids)
+    adjacency = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n, n))
+    distances, predecessors = scipy.sparse.csgraph.dijkstra(
+        adjacency, directed=False, return_predecessors=True)
+    # the graph is undirected, so the step after i on the path i -> j is the
+    # step before i on the path j -> i
+    next_hop = predecessors.T.astype(np.int32)
+    np.fill_diagonal(next_hop, np.arange(n))
+    return viewpoint_ids, distances.astype(np.float32), next_hop
+
+
 def load_datasets(splits):
     data = []
     for split in splits: